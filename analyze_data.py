@@ -1,44 +1,498 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import gc
+import json
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, product
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+from pyarrow import dataset as ds
+from pyarrow import parquet as pq
 
+# file names of bid-ask data saved before the averaged_quotes dataset, e.g. 2021-02-03_ESGV.csv
+BA_DATA_NAME = re.compile(r'^([0-9]{4}-[0-9]{2}-[0-9]{2})_([A-Z]{2,6})\.csv$')
+# seconds between market open at 9:30 am and close at 4 pm
+MARKET_SECONDS = 3600 * 6.5
+# market open on the placeholder date that all days are plotted against
+MARKET_OPEN = np.datetime64('2021-01-01T09:30', 'ns')
+# parser options shared by every bid-ask file read, only the unnamed index column and
+# the relative spread are parsed. Threads are used across files rather than within one.
+CSV_READ_OPTIONS = pa_csv.ReadOptions(use_threads=False, block_size=1 << 20)
+CSV_CONVERT_OPTIONS = pa_csv.ConvertOptions(column_types={'': pa.float64(), 'relative spread': pa.float32()},
+                                            include_columns=['', 'relative spread'])
+# every column of the files, in the types of the averaged_quotes dataset
+MIGRATE_CONVERT_OPTIONS = pa_csv.ConvertOptions(column_types={'': pa.float32(), 'bid': pa.float32(), 'ask': pa.float32(),
+                                                              'relative spread': pa.float32()},
+                                                include_columns=['', 'bid', 'ask', 'relative spread'])
+# columns of the saved averaged data; single precision is plenty for prices and spreads
+AVERAGED_DATA_SCHEMA = pa.schema([('date', pa.string()), ('symbol', pa.string()), ('time', pa.float32()),
+                                  ('bid', pa.float32()), ('ask', pa.float32()), ('relative spread', pa.float32())])
 
-def get_date_etf_list_from_data(directory='data'):
+def get_date_etf_list_from_data(directory='data', use_cache=True):
     """
     Returns list of dates and etfs based on files in the given directory
 
+    The result is saved to _index.json in the directory and reused until files
+    are added to or removed from the directory.
+
     Parameters
     ----------
     directory : str, optional
-        Directory where CSV files are stored. The default is 'data'.
+        Directory where data files are stored. The default is 'data'.
+    use_cache : bool, optional
+        Whether to read and write _index.json. The default is True.
 
     Returns
     -------
     dates : list of str
-        Strings of dates found in files. Format YYYY-MM-DD.
+        Sorted strings of dates found in files. Format YYYY-MM-DD.
     etfs : list of str
-        Strings of ETF ticker symbols.
+        Sorted strings of ETF ticker symbols.
 
     """
-    files = os.listdir(directory)
-    files = [f.split('.csv')[0] for f in files if '.csv' in f]
+    index_path = os.path.join(directory, '_index.json')
+    if use_cache:
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+            if index['mtime'] == os.stat(directory).st_mtime_ns:
+                return index['dates'], index['etfs']
+        except (OSError, ValueError, KeyError):
+            pass
+    # taken before the scan, so a file added during the scan changes the mtime of the next call
+    mtime = os.stat(directory).st_mtime_ns
     dates = set()
     etfs = set()
-    ba_data_name = re.compile('[0-9]{4}\-[0-9]{2}\-[0-9]{2}_[A-Z]{2,6}')
-    for f in files:
-        if ba_data_name.match(f):
-            date, etf = f.split('_')
-            dates.add(date)
-            etfs.add(etf)
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            match = BA_DATA_NAME.match(entry.name)
+            if match:
+                dates.add(match.group(1))
+                etfs.add(match.group(2))
+    # sorted lists give lexsorted (dates, etf) columns downstream
+    dates, etfs = sorted(dates), sorted(etfs)
+    if use_cache:
+        try:
+            # creating the index changes the directory, so the first index is rebuilt once on the next call
+            with open(index_path, 'w') as f:
+                json.dump({'mtime': mtime, 'dates': dates, 'etfs': etfs}, f)
+        except OSError:
+            pass
     return dates, etfs
 
-def create_and_save_quoated_spread_data(directory='data', sample_frequency=60, ignore_errors=1):
+def read_data_table(directory, date, etf, convert_options, ignore_errors=1):
+    """
+    Read the csv file of one ETF on one day.
+
+    Parameters
+    ----------
+    directory : str
+        Folder containing data to be read.
+    date : str
+        Date of the data. Format YYYY-MM-DD.
+    etf : str
+        ETF ticker symbol.
+    convert_options : pyarrow.csv.ConvertOptions
+        Columns to read and their types, e.g. CSV_CONVERT_OPTIONS.
+    ignore_errors : int, optional
+        Level of ignoring errors in file reading. See
+        create_and_save_quoated_spread_data. The default is 1.
+
+    Returns
+    -------
+    pa.Table or None
+        Columns of the file, with the seconds after 9:30 am in the column
+        named ''. None if the file could not be found and the error was
+        ignored.
+
+    """
+    path = os.path.join(directory, '{}_{}.csv'.format(date, etf))
+    try:
+        with open(path, 'rb') as f:
+            return pa_csv.read_csv(f, read_options=CSV_READ_OPTIONS, convert_options=convert_options)
+    except FileNotFoundError as e:
+        if ignore_errors == 0:
+            raise e
+        elif ignore_errors == 1:
+            print("Failed to find file for {} on {}".format(etf, date))
+        elif ignore_errors == 2:
+            pass
+        else:
+            raise AttributeError("ignore_errors must be 0, 1, 2. Given {}".format(ignore_errors))
+        return None
+
+def read_relative_spread(directory, date, etf, ignore_errors=1):
+    """
+    Read the relative spread of one ETF on one day.
+
+    Reads date_etf.csv, which holds days saved before the download script
+    wrote the averaged_quotes dataset.
+
+    Parameters
+    ----------
+    directory : str
+        Folder containing data to be read.
+    date : str
+        Date of the data. Format YYYY-MM-DD.
+    etf : str
+        ETF ticker symbol.
+    ignore_errors : int, optional
+        Level of ignoring errors in file reading. See
+        create_and_save_quoated_spread_data. The default is 1.
+
+    Returns
+    -------
+    pd.Series or None
+        Relative spread indexed by seconds after 9:30 am. None if the file
+        could not be found and the error was ignored.
+
+    """
+    table = read_data_table(directory, date, etf, CSV_CONVERT_OPTIONS, ignore_errors)
+    if table is None:
+        return None
+    return pd.Series(table.column('relative spread').to_numpy(), index=table.column('').to_numpy(),
+                     name='relative spread')
+
+def bucket_mean(seconds, values, sample_frequency):
+    """
+    Average values into consecutive buckets spanning the trading day.
+
+    Parameters
+    ----------
+    seconds : np.ndarray
+        Sorted seconds after 9:30 am of each value.
+    values : np.ndarray
+        Values to average. Either 1-D or 2-D with one row per second.
+    sample_frequency : int
+        Number of seconds of each bucket.
+
+    Returns
+    -------
+    means : np.ndarray
+        Mean of the non-NaN values in each bucket, with one row per bucket.
+        Buckets without values are NaN.
+
+    """
+    n_buckets = int(np.ceil(MARKET_SECONDS / sample_frequency))
+    buckets = (seconds // sample_frequency).astype(np.int64)
+    in_day = (buckets >= 0) & (buckets < n_buckets)
+    buckets, values = buckets[in_day], values[in_day]
+    per_bucket = len(buckets) // n_buckets
+    if per_bucket > 0 and np.array_equal(buckets, np.arange(n_buckets * per_bucket) // per_bucket):
+        # regular grid with the same number of samples in every bucket, e.g. the 5 second averages
+        rows = values.reshape((n_buckets, per_bucket) + values.shape[1:])
+        # buckets with only NaN values are left NaN. errstate is per thread, unlike warning filters
+        with np.errstate(invalid='ignore'):
+            return (np.nansum(rows, axis=1) / (~np.isnan(rows)).sum(axis=1)).astype(values.dtype, copy=False)
+    means = np.full((n_buckets,) + values.shape[1:], np.nan, dtype=values.dtype)
+    if len(buckets) == 0:
+        return means
+    # seconds are sorted, so each bucket is a contiguous run of rows
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    valid = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(valid, values, 0), starts, axis=0, dtype=np.float64)
+    counts = np.add.reduceat(valid, starts, axis=0, dtype=np.int64)
+    with np.errstate(invalid='ignore'):
+        means[buckets[starts]] = sums / counts
+    return means
+
+def bucket_midpoints(sample_frequency):
+    """
+    Returns the seconds after 9:30 am of the middle of each bucket used by bucket_mean.
+
+    Parameters
+    ----------
+    sample_frequency : int
+        Number of seconds of each bucket.
+
+    Returns
+    -------
+    np.ndarray
+        Midpoint of each bucket in seconds.
+
     """
-    Convert quoted spreads from various CSV files of various days' and ETFs' data to one data frame.
+    n_buckets = int(np.ceil(MARKET_SECONDS / sample_frequency))
+    return (np.arange(n_buckets) + 0.5) * sample_frequency
+
+def iter_relative_spreads(directory, keys, ignore_errors=1, max_workers=None, sample_frequency=None):
+    """
+    Read the relative spreads of the given days and ETFs from their data files.
+
+    Parameters
+    ----------
+    directory : str
+        Folder containing data to be read.
+    keys : list of tuple
+        (date, etf) of the files to read, with dates in format YYYY-MM-DD.
+    ignore_errors : int, optional
+        Level of ignoring errors in file reading. See
+        create_and_save_quoated_spread_data. The default is 1.
+    max_workers : int, optional
+        Number of threads used to read files. The default is None, which lets
+        ThreadPoolExecutor decide.
+    sample_frequency : int, optional
+        If given, each series is averaged into buckets of this many seconds
+        right after it is read. The default is None.
+
+    Yields
+    ------
+    key : tuple of str
+        (date, etf) of the file, in the order of keys.
+    spread : pd.Series, np.ndarray or None
+        Relative spread series, or array of bucket means at
+        bucket_midpoints(sample_frequency) if sample_frequency is given. None
+        if the file could not be found.
+
+    """
+    def read(key):
+        series = read_relative_spread(directory, *key, ignore_errors)
+        if series is None or sample_frequency is None:
+            return series
+        return bucket_mean(series.index.to_numpy(), series.to_numpy(), sample_frequency)
+
+    # files are small and the parser releases the GIL, so threads overlap the I/O
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for index, (key, spread) in enumerate(zip(keys, executor.map(read, keys))):
+            yield key, spread
+            if index%1000 == 0:
+                print('finished {}/{} files'.format(index, len(keys)))
+
+def read_relative_spreads(directory='data', ignore_errors=1, max_workers=None, sample_frequency=None):
+    """
+    Read the relative spreads of all days and ETFs found in data files.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Folder containing data to be read. The default is 'data'.
+    ignore_errors : int, optional
+        Level of ignoring errors in file reading. See
+        create_and_save_quoated_spread_data. The default is 1.
+    max_workers : int, optional
+        Number of threads used to read files. The default is None, which lets
+        ThreadPoolExecutor decide.
+    sample_frequency : int, optional
+        If given, each series is averaged into buckets of this many seconds
+        right after it is read. The default is None.
+
+    Returns
+    -------
+    spreads : dict
+        Relative spread series keyed by (date, etf) tuples. If
+        sample_frequency is given, arrays of bucket means at
+        bucket_midpoints(sample_frequency) instead.
+
+    """
+    dates, etfs = get_date_etf_list_from_data(directory)
+    keys = list(product(dates, etfs))
+    spreads = iter_relative_spreads(directory, keys, ignore_errors, max_workers, sample_frequency)
+    return {key: spread for key, spread in spreads if spread is not None}
+
+def read_averaged_quotes(directory='data', etfs=None):
+    """
+    Read relative spreads from the averaged_quotes dataset written by get_quotes_alpaca_polygon.py.
+
+    Only the needed columns are read, and if etfs is given only the files of
+    those ETFs are opened.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Folder containing the averaged_quotes dataset. The default is 'data'.
+    etfs : list of str, optional
+        ETF ticker symbols to read. The default is None, which reads all.
+
+    Returns
+    -------
+    pd.DataFrame
+        date, etf, time and relative spread columns with one row per value.
+
+    """
+    dataset = ds.dataset(os.path.join(directory, 'averaged_quotes'), format='parquet', partitioning='hive')
+    row_filter = None if etfs is None else ds.field('symbol').isin(list(etfs))
+    table = dataset.to_table(columns=['date', 'symbol', 'time', 'relative spread'], filter=row_filter)
+    return table.to_pandas().rename(columns={'symbol': 'etf'})
+
+def save_symbol_quotes(symbol, frames, directory='data'):
+    """
+    Saves averaged data of various days of one symbol to the averaged_quotes dataset.
+
+    The dataset is partitioned by symbol, so each call adds one file to
+    averaged_quotes/symbol=<symbol>/ rather than one file per day.
+
+    Parameters
+    ----------
+    symbol : str
+        STOCK/ETF name of the data
+    frames : dict
+        Data frames with time, bid, ask and relative spread columns, as from
+        get_averaged_quotes in get_quotes_alpaca_polygon.py, keyed by date string.
+    directory : str, optional
+        Folder containing the dataset. The default is 'data'.
+
+    Returns
+    -------
+    None.
+
+    """
+    tables = [pa.Table.from_pandas(frame.assign(date=date, symbol=symbol), schema=AVERAGED_DATA_SCHEMA,
+                                   preserve_index=False) for date, frame in frames.items()]
+    # small pages keep finer min/max statistics for filtered reads
+    pq.write_to_dataset(pa.concat_tables(tables), root_path=os.path.join(directory, 'averaged_quotes'),
+                        partition_cols=['symbol'], compression='zstd', data_page_size=64 * 1024)
+
+def get_saved_days(directory='data'):
+    """
+    Get the symbols and days already saved to the averaged_quotes dataset.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Folder containing the dataset. The default is 'data'.
+
+    Returns
+    -------
+    set of tuple
+        (symbol, date) pairs that have been saved.
+
+    """
+    path = os.path.join(directory, 'averaged_quotes')
+    if not os.path.isdir(path):
+        return set()
+    saved = ds.dataset(path, format='parquet', partitioning='hive').to_table(columns=['symbol', 'date'])
+    return set(zip(saved.column('symbol').to_pylist(), saved.column('date').to_pylist()))
+
+def migrate_to_parquet(directory='data', ignore_errors=1, max_workers=None):
+    """
+    Add the days saved as csv files to the averaged_quotes dataset.
+
+    Reading the dataset avoids the overhead of opening and parsing thousands
+    of small files every time the quoted spreads are rebuilt. Days already in
+    the dataset are skipped. The csv files are left in place, and are not
+    read by read_quoted_spread once their days are in the dataset.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Folder containing data to be read. The default is 'data'.
+    ignore_errors : int, optional
+        Level of ignoring errors in file reading. See
+        create_and_save_quoated_spread_data. The default is 1.
+    max_workers : int, optional
+        Number of threads used to read files. The default is None, which lets
+        ThreadPoolExecutor decide.
+
+    Returns
+    -------
+    None.
+
+    """
+    saved = get_saved_days(directory)
+    dates, etfs = get_date_etf_list_from_data(directory)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for etf in etfs:
+            missing = [date for date in dates if (etf, date) not in saved]
+            tables = executor.map(lambda date: read_data_table(directory, date, etf, MIGRATE_CONVERT_OPTIONS,
+                                                               ignore_errors), missing)
+            frames = {date: table.to_pandas().rename(columns={'': 'time'})
+                      for date, table in zip(missing, tables) if table is not None}
+            # each ETF is added as one file of the dataset
+            if frames:
+                save_symbol_quotes(etf, frames, directory)
+
+def iter_averaged_quotes(directory='data', sample_frequency=None):
+    """
+    Read the relative spreads of every day in the averaged_quotes dataset.
+
+    The dataset is read one ETF at a time, so only the rows of one ETF are
+    held in memory.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Folder containing the averaged_quotes dataset. The default is 'data'.
+    sample_frequency : int, optional
+        If given, each day is averaged into buckets of this many seconds
+        right after it is read. The default is None.
+
+    Yields
+    ------
+    key : tuple of str
+        (date, etf) of the day.
+    spread : pd.Series or np.ndarray
+        Relative spread series indexed by seconds after 9:30 am, or array of
+        bucket means at bucket_midpoints(sample_frequency) if
+        sample_frequency is given.
+
+    """
+    # the dataset is partitioned by symbol, so its folders name the ETFs
+    with os.scandir(os.path.join(directory, 'averaged_quotes')) as entries:
+        etfs = sorted(entry.name[len('symbol='):] for entry in entries
+                      if entry.is_dir() and entry.name.startswith('symbol='))
+    for etf in etfs:
+        quotes = read_averaged_quotes(directory, [etf])
+        # days may be spread over several files, so order rows by day and then time
+        codes, dates = pd.factorize(quotes['date'], sort=True)
+        seconds = quotes['time'].to_numpy(np.float64)
+        order = np.lexsort((seconds, codes))
+        codes, seconds = codes[order], seconds[order]
+        spread = quotes['relative spread'].to_numpy()[order]
+        starts = np.searchsorted(codes, np.arange(len(dates) + 1))
+        for date, start, end in zip(dates, starts[:-1], starts[1:]):
+            if sample_frequency is None:
+                yield (date, etf), pd.Series(spread[start:end], index=seconds[start:end], name='relative spread')
+            else:
+                yield (date, etf), bucket_mean(seconds[start:end], spread[start:end], sample_frequency)
+
+def save_quoted_spread(quoted_spread, directory='data'):
+    """
+    Save quoted spreads to quoted_spread.pkl and quoted_spread.feather.
+
+    Each file is saved independently, so failing to write one does not prevent
+    writing the other.
+
+    Parameters
+    ----------
+    quoted_spread : pd.DataFrame
+        Quoted spread data for various times, days, and ETFs.
+    directory : str, optional
+        Folder to save the files to. The default is 'data'.
+
+    Returns
+    -------
+    bool
+        Whether both files were saved.
+
+    """
+    success = True
+    try:
+        # protocol 5 writes the numpy buffers straight to the file without an in-memory copy
+        with open(os.path.join(directory, 'quoted_spread.pkl'), 'wb') as f:
+            quoted_spread.to_pickle(f, protocol=5)
+    except OSError as e:
+        print('Failed to save quoted_spread.pkl: {}'.format(e))
+        success = False
+    try:
+        # feather needs string column names, so save in long format with one row per value
+        long_spread = quoted_spread.rename_axis('time').stack(['dates', 'etf']).rename('relative spread')
+        long_spread.reset_index().to_feather(os.path.join(directory, 'quoted_spread.feather'), compression='zstd')
+    except (OSError, ImportError, ValueError) as e:
+        print('Failed to save quoted_spread.feather: {}'.format(e))
+        success = False
+    return success
+
+def read_quoted_spread(directory='data', sample_frequency=60, ignore_errors=1, max_workers=None):
+    """
+    Read quoted spreads from various files of various days' and ETFs' data into one data frame.
+
+    If the averaged_quotes dataset exists, it is read along with the per-day
+    files of days that are not in it.
 
     Parameters
     ----------
@@ -51,44 +505,89 @@ def create_and_save_quoated_spread_data(directory='data', sample_frequency=60, i
             0 = raise exceptions
             1 = catch and print unavailable files
             2 = catch and pass
+    max_workers : int, optional
+        Number of threads used to read files. The default is None, which lets
+        ThreadPoolExecutor decide.
 
     Returns
     -------
     quoted_spread : pd.DataFrame
-        If an exeption occurs, returns data frame of quoted spread data. If no
-        exception, returns None.
+        Quoted spread data with (dates, etf) columns and an index of market
+        times on 2021-01-01. Days and ETFs whose file could not be found
+        have no column.
 
     """
+    averaged = {}
+    if os.path.isdir(os.path.join(directory, 'averaged_quotes')):
+        averaged = dict(iter_averaged_quotes(directory, sample_frequency))
+    # only days saved as csv files before the download script wrote the dataset are read from files
     dates, etfs = get_date_etf_list_from_data(directory)
-    mi = pd.MultiIndex.from_product([dates, etfs], names=['dates','etf'])
-    quoted_spread = pd.DataFrame(columns=mi)
-    for index, date in enumerate(dates):
-        for etf in etfs:
-            try:
-                df = pd.read_csv(os.path.join(directory, '{}_{}.csv'.format(date, etf)), index_col=0)
-            except FileNotFoundError as e:
-                if ignore_errors == 0:
-                    raise e
-                elif ignore_errors == 1:
-                    print("Failed to find file for {} on {}".format(etf, date))
-                elif ignore_errors == 2:
-                    pass
-                else:
-                    raise AttributeError("ignore_errors must be 0, 1, 2. Given {}".format(ignore_errors))
-            quoted_spread[(date, etf)] = df['relative spread']
-        if index%10 == 0:
-            print('finished {}/{} dates'.format(index, len(dates)))
+    missing = [key for key in product(dates, etfs) if key not in averaged]
+    spreads = iter_relative_spreads(directory, missing, ignore_errors, max_workers, sample_frequency)
+    # sorted keys give lexsorted (dates, etf) columns
+    keys = sorted(averaged.keys() | set(missing))
+    if sample_frequency is None:
+        # raw days need not share times, so let concat align them in a single allocation
+        averaged.update((key, spread) for key, spread in spreads if spread is not None)
+        keys = [key for key in keys if key in averaged]
+        quoted_spread = pd.concat([averaged[key] for key in keys], axis=1, keys=keys, copy=False)
+    else:
+        # bucket means are written straight into one float32 block
+        positions = {key: column for column, key in enumerate(keys)}
+        midpoints = bucket_midpoints(sample_frequency)
+        values = np.empty((len(midpoints), len(keys)), dtype=np.float32)
+        found = np.zeros(len(keys), dtype=bool)
+        for key, means in chain(averaged.items(), spreads):
+            if means is not None:
+                values[:, positions[key]] = means
+                found[positions[key]] = True
+        columns = pd.MultiIndex.from_arrays([[key[0] for key in keys], [key[1] for key in keys]])
+        if not found.all():
+            values, columns = values[:, found], columns[found]
+        quoted_spread = pd.DataFrame(values, index=midpoints, columns=columns)
+    quoted_spread.columns.names = ['dates','etf']
+    nanoseconds = np.round(quoted_spread.index.to_numpy() * 1e9).astype(np.int64)
+    quoted_spread.index = pd.DatetimeIndex(MARKET_OPEN + nanoseconds.astype('timedelta64[ns]'))
+    return quoted_spread
+
+def create_and_save_quoated_spread_data(directory='data', sample_frequency=60, ignore_errors=1, max_workers=None):
+    """
+    Convert quoted spreads from various files of various days' and ETFs' data to one data frame.
+
+    If the averaged_quotes dataset exists, it is read along with the per-day
+    files of days that are not in it.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Folder containing data to be read. The default is 'data'.
+    sample_frequency : int, optional
+        Number of seconds of each data lump. The default is 60.
+    ignore_errors : int, optional
+        Level of ignoring errors in file reading:
+            0 = raise exceptions
+            1 = catch and print unavailable files
+            2 = catch and pass
+    max_workers : int, optional
+        Number of threads used to read files. The default is None, which lets
+        ThreadPoolExecutor decide.
+
+    Returns
+    -------
+    quoted_spread : pd.DataFrame
+        If saving a file fails, returns data frame of quoted spread data. If
+        all files are saved, returns None.
+
+    """
+    # loading allocates many short-lived objects but no reference cycles, so skip cyclic gc passes
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
     try:
-        basetime =  pd.to_datetime('2021-01-01') + pd.Timedelta(hours=9, minutes=30)
-        timedeltas = pd.TimedeltaIndex([pd.Timedelta(seconds=x) for x in quoted_spread.index])
-        quoted_spread.index = basetime + timedeltas
-        if sample_frequency is not None:
-            resample_str = '{}s'.format(sample_frequency)
-            quoted_spread = quoted_spread.resample(resample_str).mean()
-            quoted_spread.index = quoted_spread.index + pd.Timedelta(seconds = sample_frequency / 2)
-        quoted_spread.to_pickle(os.path.join(directory, 'quoted_spread.pkl'), protocol=4)
-        quoted_spread.to_csv(os.path.join(directory, 'quoted_spread.csv.zip'))
-    except:
+        quoted_spread = read_quoted_spread(directory, sample_frequency, ignore_errors, max_workers)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    if not save_quoted_spread(quoted_spread, directory):
         return quoted_spread
 
 if __name__ == '__main__':
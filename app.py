@@ -10,21 +10,20 @@ It assumes the computer is at US East Coast Time.
 """
 
 import os
+from itertools import islice
 
 import pandas as pd
 import numpy as np
 
-from itertools import product
-
 import streamlit as st
 
 from bokeh.plotting import figure
 from bokeh.models.tools import HoverTool
-from bokeh.models import NumeralTickFormatter, DatetimeTickFormatter, Rect, ColumnDataSource, VBar, LabelSet
+from bokeh.models import NumeralTickFormatter, DatetimeTickFormatter, Rect, ColumnDataSource, VBar
 
 from streamlit_metrics import metric_row
 
-def display_method_to_choose_etfs(selected_method_choose_dates, all_etfs, etf_data, sl_obj):
+def display_method_to_choose_etfs(selected_method_choose_dates, all_etfs, etf_data, log_bounds, sl_obj):
     """
     Generates various streamlit options for selecting which ETFs to display.
 
@@ -36,6 +35,8 @@ def display_method_to_choose_etfs(selected_method_choose_dates, all_etfs, etf_da
         List of all ETF tickers.
     etf_data : pd.DataFrame
         Dataframe containing bulk data about ETFs.
+    log_bounds : dict
+        Slider bounds (log10 of min and max) for columns of etf_data.
     sl_obj : streamlit
         Stremlit object to place the elements.
 
@@ -45,11 +46,11 @@ def display_method_to_choose_etfs(selected_method_choose_dates, all_etfs, etf_da
         List of str tickers chosen by users.
 
     """
-    selected_etfs = all_etfs
+    # an Index keeps the order of all_etfs and intersects without building Python sets
+    selected_etfs = pd.Index(all_etfs)
     if 'By volume traded' in selected_method_choose_dates:
         selection_data = etf_data['volume (shares/day)']
-        log_min = float(np.floor(np.log10(selection_data.min())))
-        log_max = float(np.ceil(np.log10(selection_data.max())))
+        log_min, log_max = log_bounds['volume (shares/day)']
         min_vol, max_vol = sl_obj.slider('Average Volume (shares/day)',
                          min_value=float(log_min),
                          max_value=float(log_max),
@@ -57,12 +58,12 @@ def display_method_to_choose_etfs(selected_method_choose_dates, all_etfs, etf_da
                          step=float(log_min - log_max) / 100,
                          format='10^%.1f'
                          )
-        selected = (selection_data >= 10**min_vol) & (selection_data <= 10**max_vol)
-        selected_etfs = list(set(selected_etfs) & set(selection_data[selected].index))
+        values = selection_data.to_numpy()
+        selected = (values >= 10**min_vol) & (values <= 10**max_vol)
+        selected_etfs = selected_etfs.intersection(selection_data.index[selected], sort=False)
     if 'By market cap' in selected_method_choose_dates:
         selection_data = etf_data['net assets (million USD)']
-        log_min = float(np.floor(np.log10(selection_data.min())))
-        log_max = float(np.ceil(np.log10(selection_data.max())))
+        log_min, log_max = log_bounds['net assets (million USD)']
         min_vol, max_vol = sl_obj.slider('Market Cap as of 2021-02-21 (million USD)',
                          min_value=float(log_min),
                          max_value=float(log_max),
@@ -70,19 +71,25 @@ def display_method_to_choose_etfs(selected_method_choose_dates, all_etfs, etf_da
                          step=float(log_min - log_max) / 100,
                          format='10^%.1f'
                          )
-        selected = (selection_data >= 10**min_vol) & (selection_data <= 10**max_vol)
-        selected_etfs = list(set(selected_etfs) & set(selection_data[selected].index))
+        values = selection_data.to_numpy()
+        selected = (values >= 10**min_vol) & (values <= 10**max_vol)
+        selected_etfs = selected_etfs.intersection(selection_data.index[selected], sort=False)
     if 'Only ESG ETFs' in selected_method_choose_dates:
         esg_etfs = etf_data[etf_data['esg'] == True].index
-        selected_etfs = list(set(selected_etfs) & set(esg_etfs))
+        selected_etfs = selected_etfs.intersection(esg_etfs, sort=False)
     if 'choose specific ETFs' in selected_method_choose_dates:
         selected_etfs = sl_obj.multiselect('Which ETFs do you want to look at', list(selected_etfs), ['ESGV','VTI','BND', 'VCEB', 'VSGX'])
-    return selected_etfs
+    return list(selected_etfs)
 
+# data is the cached quoted spread frame, so hash it by identity rather than by content
+@st.cache(hash_funcs={pd.DataFrame: id}, allow_output_mutation=True, max_entries=32, show_spinner=False)
 def get_averages(data, selected_dates, selected_etfs):
     """
     Obtain average values of various ETFs across the trading day.
 
+    Results are cached, so plots, metrics and ratios computed for the same
+    selection share one calculation. The returned frame must not be modified.
+
     Parameters
     ----------
     data : pd.DataFrame
@@ -98,9 +105,27 @@ def get_averages(data, selected_dates, selected_etfs):
         Data frame of average values in ETFs at various times during tradiing day.
 
     """
-    potential_columns = product(selected_dates, selected_etfs)
-    actual_columns = [x for x in potential_columns if x in data.columns]
-    return data[actual_columns].T.groupby(level=['etf']).mean().T
+    # select columns by the integer codes of the column levels instead of by label
+    columns = data.columns
+    selected = np.flatnonzero(columns.levels[0].isin(selected_dates)[columns.codes[0]]
+                              & columns.levels[1].isin(selected_etfs)[columns.codes[1]])
+    # order the selected columns so each ETF is one contiguous block
+    etf_codes = columns.codes[1][selected]
+    order = np.argsort(etf_codes, kind='stable')
+    etf_codes, block_starts = np.unique(etf_codes[order], return_index=True)
+    etf_names = columns.levels[1][etf_codes]
+    if not len(selected):
+        return pd.DataFrame(index=data.index, columns=etf_names, dtype=float)
+    # rows of the transposed array are the (contiguous) columns of the frame
+    values = data.to_numpy().T[selected[order]]
+    missing = np.isnan(values)
+    values[missing] = 0
+    # counts are block sizes less the missing values; reduceat is much faster on floats than on bools
+    block_sizes = np.diff(np.append(block_starts, len(selected)))
+    counts = block_sizes[:, np.newaxis] - np.add.reduceat(missing.astype(np.float32), block_starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.add.reduceat(values, block_starts, axis=0, dtype=np.float64) / counts
+    return pd.DataFrame(means.T, index=data.index, columns=etf_names)
 
 def add_trade_windows(p, t_new, t_old, ymax):
     """
@@ -159,7 +184,7 @@ def format_plots(p, ymax=None):
         num_formatter='0.00%'
     else:
         num_zeros = int(np.log10(1/ymax)-.4)
-        num_formatter = '0.'+''.join(['0' for x in range(num_zeros)])+'%'
+        num_formatter = '0.' + '0' * num_zeros + '%'
     p.yaxis.formatter = NumeralTickFormatter(format=num_formatter)
     p.xaxis.formatter = DatetimeTickFormatter(hours='%H:%M')
     p.xaxis.axis_label = 'Market Time'
@@ -168,10 +193,14 @@ def format_plots(p, ymax=None):
     p.ygrid.grid_line_color = None
     p.toolbar.autohide = True
     
+# built figures are reused across reruns that only change unrelated widgets
+@st.cache(hash_funcs={pd.DataFrame: id}, allow_output_mutation=True, max_entries=32, show_spinner=False)
 def make_multi_etf_plot(selected_etfs, selected_dates, t_new, t_old, quoted_spread):
     """
     Make plot with multiple ETF averages
 
+    Figures are cached, so the returned figure must not be modified.
+
     Parameters
     ----------
     selected_etfs : list of str
@@ -193,18 +222,21 @@ def make_multi_etf_plot(selected_etfs, selected_dates, t_new, t_old, quoted_spre
     """
     t_all = t_new + t_old
     average_data = get_averages(quoted_spread, selected_dates, selected_etfs)
+    ymax = np.nanmax(average_data.to_numpy())
 
     p = figure(plot_width=400, plot_height=400, x_axis_type="datetime",
                toolbar_location='below', title='quoted Bid-Ask Spread for various ETFs',
                x_range=(pd.Timestamp('2021-01-01 9:30'), max(t_all)+pd.Timedelta(hours=1.5)),
-               y_range=(0, average_data.max().max()+0.0001))
+               y_range=(0, ymax+0.0001))
     #trading windows
-    add_trade_windows(p, t_new, t_old, average_data.max().max())
+    add_trade_windows(p, t_new, t_old, ymax)
 
-    # etf lines
+    # etf lines, sharing one data source so the time axis is only sent once
+    source = ColumnDataSource({'time': average_data.index.values,
+                               **{etf: average_data[etf].to_numpy() for etf in selected_etfs}})
     renders = []
     for etf in selected_etfs:
-        renders.append(p.line(average_data.index, average_data[etf],# set visual properties for selected glyphs
+        renders.append(p.line('time', etf, source=source,# set visual properties for selected glyphs
                         hover_color="firebrick",
                         hover_alpha=1,
                         # set visual properties for non-selected glyphs
@@ -217,14 +249,17 @@ def make_multi_etf_plot(selected_etfs, selected_dates, t_new, t_old, quoted_spre
     formatters = { "$x": "datetime",}
     p.add_tools(HoverTool(tooltips=tooltips, renderers=renders, formatters=formatters))
 
-    format_plots(p, ymax=average_data.max().max()+0.0001)
+    format_plots(p, ymax=ymax+0.0001)
 
     return p
 
+@st.cache(hash_funcs={pd.DataFrame: id}, allow_output_mutation=True, max_entries=32, show_spinner=False)
 def make_single_etf_plot(selected_etf, selected_dates, t_new, t_old, quoted_spread, supress_hover_after= 10000):
     """
     Plots data for a single ETF for multiple days.
 
+    Figures are cached, so the returned figure must not be modified.
+
     Parameters
     ----------
     selected_etfs : list of str
@@ -248,31 +283,37 @@ def make_single_etf_plot(selected_etf, selected_dates, t_new, t_old, quoted_spre
     """
     t_all = t_new + t_old
     average_data = get_averages(quoted_spread, selected_dates, [selected_etf])
+    ymax = np.nanmax(average_data.to_numpy())
 
     p = figure(plot_width=400, plot_height=400, x_axis_type="datetime",
                toolbar_location='below', title='Quoted spread for {}'.format(selected_etf),
                x_range=(pd.Timestamp('2021-01-01 9:30'), max(t_all)+pd.Timedelta(hours=1.5)),
-               y_range=(0, average_data.max().max()+0.0001))
-    add_trade_windows(p, t_new, t_old, average_data.max().max())
-    # etf lines
+               y_range=(0, ymax+0.0001))
+    add_trade_windows(p, t_new, t_old, ymax)
+    # day and average lines share one data source, so the time axis is only sent once
+    source = ColumnDataSource({'time': average_data.index.values,
+                               'average': average_data[selected_etf].to_numpy()})
     renders = []
     if len(selected_dates) > 1:
-        for date in selected_dates:
-            try:
-                render = p.line(quoted_spread.index, quoted_spread.loc[:,(date,selected_etf)],# set visual properties for selected glyphs
-                            hover_color="firebrick",
-                            hover_alpha=0.33,
-                            color="grey",
-                            alpha=0.25,
-                            name=date)
-            except KeyError:
-                continue
+        # column positions of the days with data for this ETF (-1 where missing), taken as one block
+        day_positions = quoted_spread.columns.get_indexer(pd.MultiIndex.from_product([selected_dates, [selected_etf]]))
+        has_data = day_positions >= 0
+        day_names = [date for date, keep in zip(selected_dates, has_data) if keep]
+        day_values = quoted_spread.to_numpy()[:, day_positions[has_data]]
+        source.data.update(zip(day_names, day_values.T))
+        for date in day_names:
+            render = p.line('time', date, source=source,# set visual properties for selected glyphs
+                        hover_color="firebrick",
+                        hover_alpha=0.33,
+                        color="grey",
+                        alpha=0.25,
+                        name=date)
             if len(selected_dates) < supress_hover_after:
                 renders.append(render)
         average_name = 'average'
     else:
         average_name = selected_dates[0]
-    renders.append(p.line(average_data.index, average_data[selected_etf],# set visual properties for selected glyphs
+    renders.append(p.line('time', 'average', source=source,# set visual properties for selected glyphs
                     hover_color="firebrick",
                     hover_alpha=0.75,
                     color="black",
@@ -287,10 +328,42 @@ def make_single_etf_plot(selected_etf, selected_dates, t_new, t_old, quoted_spre
     format_plots(p)
     return p
  
+@st.cache(allow_output_mutation=True, show_spinner=False)
+def load_bid_ask_data(selected_etf, selected_date, directory):
+    """
+    Load bid and ask prices over one trading day for one ETF. Cached across reruns.
+
+    Parameters
+    ----------
+    selected_etf : str
+        ETF ticker of data to load.
+    selected_date : str
+        Date of data to load. In format YYYY-MM-DD.
+    directory : str
+        Folder containing ETF bid and ask price data. File must be in format date_etf.csv.
+
+    Returns
+    -------
+    data : pd.DataFrame
+        Bid and ask prices indexed by market time.
+
+    """
+    # only the seconds index, bid and ask are plotted; declaring them float skips type inference
+    data = pd.read_csv(os.path.join(directory, '{}_{}.csv'.format(selected_date, selected_etf)),
+                       index_col=0, usecols=[0, 1, 2], dtype='float64')
+    basetime =  pd.to_datetime('2021-01-01') + pd.Timedelta(hours=9, minutes=30)
+    timedeltas = pd.to_timedelta(data.index.to_numpy(), unit='s')
+    data.index = timedeltas + basetime
+    return data
+
+# the introduction plot only changes with the trade windows, so reruns from other widgets reuse the figure
+@st.cache(allow_output_mutation=True, max_entries=32, show_spinner=False)
 def make_bid_ask_plot(selected_etf, selected_date, t_new, t_old, directory):
     """
     Plots bid and ask prices over one trading day for one ETF.
 
+    Figures are cached, so the returned figure must not be modified.
+
     Parameters
     ----------
     selected_etf : str
@@ -310,10 +383,7 @@ def make_bid_ask_plot(selected_etf, selected_date, t_new, t_old, directory):
         Plot of bid and ask prices.
 
     """
-    data = pd.read_csv(os.path.join(directory, '{}_{}.csv'.format(selected_date, selected_etf)), index_col=0)
-    basetime =  pd.to_datetime('2021-01-01') + pd.Timedelta(hours=9, minutes=30)
-    timedeltas = pd.TimedeltaIndex([pd.Timedelta(seconds=x) for x in data.index])
-    data.index = timedeltas + basetime
+    data = load_bid_ask_data(selected_etf, selected_date, directory)
     t_all = t_new + t_old
     bid = data.bid
     ask = data.ask
@@ -372,14 +442,13 @@ def make_relative_fee_amount(selected_ratios, t_new_text = ''):
                  line_width=0, fill_alpha=1)
     rend = p.add_glyph(source, glyph)
     rend.hover_glyph = glyph_hover
-    labels = LabelSet(x='x', level='glyph', source=source, render_mode='canvas')
     tooltips = [('etf','@desc'),
                 ('ratio','@top')]
 
     p.add_tools(HoverTool(tooltips=tooltips, renderers=[rend])) 
     
     num_zeros = int(np.log10(1/selected_ratios.max())-.4)
-    num_formatter = '0.'+''.join(['0' for x in range(num_zeros)])+'%'
+    num_formatter = '0.' + '0' * num_zeros + '%'
     p.yaxis.formatter = NumeralTickFormatter(format=num_formatter)
     p.xgrid.grid_line_color = None
     p.ygrid.grid_line_color = None
@@ -390,6 +459,43 @@ def make_relative_fee_amount(selected_ratios, t_new_text = ''):
     p.xaxis.major_label_orientation = 3.14/2
     return p
 
+# each window is cached on its own, so moving one slider does not recompute the other window.
+# a page uses two windows, so this cache keeps twice as many entries as the others
+@st.cache(hash_funcs={pd.DataFrame: id}, allow_output_mutation=True, max_entries=64, show_spinner=False)
+def get_window_quotes(quoted_spread, selected_dates, selected_etfs, t_window):
+    """
+    Average quoted spread of ETFs within one trading window.
+
+    Parameters
+    ----------
+    quoted_spread : pd.DataFrame
+        Quoted spread data for various times, days, and ETFs.
+    selected_dates : list of str
+        List of dates to obtain averages of. In format YYYY-MM-DD.
+    selected_etfs : list of str
+        List of ETF tickers
+    t_window : tuple of timestamps
+        Starting and ending timestamp of the trading window.
+
+    Returns
+    -------
+    pd.Series
+        Average of each ETF within the trading window.
+
+    """
+    df = get_averages(quoted_spread, selected_dates, selected_etfs)
+    # the time index is sorted, so the window rows are found by binary search. rows
+    # exactly at either edge are left out of the window
+    edges = np.array(t_window, dtype='datetime64[ns]')
+    start = np.searchsorted(df.index.values, edges[0], side='right')
+    end = np.searchsorted(df.index.values, edges[1], side='left')
+    # average the window rows on the ndarray, skipping missing values like DataFrame.mean
+    window = df.to_numpy()[start:end]
+    valid = ~np.isnan(window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(valid, window, 0).sum(axis=0) / valid.sum(axis=0)
+    return pd.Series(means, index=df.columns)
+
 def get_quoted_spread_change(selected_etfs, selected_dates, t_old, t_new, quoted_spread):
     """
     Get the relative change in average quoted spread between the two time windows.
@@ -413,11 +519,40 @@ def get_quoted_spread_change(selected_etfs, selected_dates, t_old, t_new, quoted
         The relative change in average quoted spread between the two time windows.
 
     """
-    df = get_averages(quoted_spread, selected_dates, selected_etfs)
-    old_quotes = df[(df.index > t_old[0]) & (df.index < t_old[1])].mean(0)
-    new_quotes = df[(df.index > t_new[0]) & (df.index < t_new[1])].mean(0)
+    old_quotes = get_window_quotes(quoted_spread, selected_dates, selected_etfs, t_old)
+    new_quotes = get_window_quotes(quoted_spread, selected_dates, selected_etfs, t_new)
     return (new_quotes / old_quotes).sort_values(ascending=False)
 
+@st.cache(hash_funcs={pd.DataFrame: id}, allow_output_mutation=True, max_entries=32, show_spinner=False)
+def get_expense_ratio_comparison(selected_etfs, selected_dates, t_new, quoted_spread, etf_data):
+    """
+    Get the ratio of quoted spread in the new trading window to the expense ratio.
+
+    Depends only on the new trading window, so it is not recomputed when the
+    old trading window changes.
+
+    Parameters
+    ----------
+    selected_etfs : list of str
+        List of ETF tickers
+    selected_dates : list of str
+        List of dates to obtain averages of. In format YYYY-MM-DD.
+    t_new : tuple of timestamps
+        Starting and ending timestamp of the new trading window.
+    quoted_spread : pd.DataFrame
+        Quoted spread data for various times, days, and ETFs.
+    etf_data : pd.DataFrame
+        Dataframe containing bulk data about ETFs.
+
+    Returns
+    -------
+    pd.Series
+        Ratio of quoted spread to expense ratio, largest first.
+
+    """
+    new_quotes = get_window_quotes(quoted_spread, selected_dates, selected_etfs, t_new)
+    return (new_quotes / (etf_data.loc[selected_etfs,'expense ratio']/100)).sort_values(ascending=False)
+
 def create_metrics(fractional_increase, nwide=4, container=st, max_rows=2):
     """
     Print information about fractional change in quoted spreads in metric form
@@ -438,24 +573,81 @@ def create_metrics(fractional_increase, nwide=4, container=st, max_rows=2):
     None.
 
     """
-    metrics = {}
-    rows = 0
-    for etf, val in dict(fractional_increase).items():
-        if len(metrics) == nwide:
-            with container:
-                metric_row(metrics)
-            metrics = {}
-            rows += 1
-            if rows == max_rows:
-                break
-        metrics[etf] = '{:.0f}%'.format((val-1)*100)
-    if len(metrics) > 0:
+    # only the first rows are shown, so format just those items
+    items = list(islice(fractional_increase.items(), nwide * max_rows))
+    for start in range(0, len(items), nwide):
+        metrics = {etf: '{:.0f}%'.format((val-1)*100) for etf, val in items[start:start + nwide]}
         with container:
             metric_row(metrics)
 
-st.write("# Bid-Ask spreads. Does time of day matter?")
-st.write("#### By Mark Goldman")
-st.write('first published March 10, 2021')
+# outputs are not hashed on every rerun, so the cached frames must not be modified
+@st.cache(allow_output_mutation=True, show_spinner=False)
+def load_quoted_spread(path='data/quoted_spread.pkl'):
+    """
+    Load quoted spread data with outliers removed. Cached across reruns.
+
+    Parameters
+    ----------
+    path : str, optional
+        Pickle file of quoted spread data. The default is 'data/quoted_spread.pkl'.
+
+    Returns
+    -------
+    quoted_spread : pd.DataFrame
+        Quoted spread data for various times, days, and ETFs.
+    all_dates : list of str
+        Sorted list of dates in format YYYY-MM-DD.
+    all_etfs : list of str
+        List of ETF tickers.
+
+    """
+    quoted_spread = pd.read_pickle(path)
+
+    # remove outliers that impact average
+    outliers = [('2020-12-16', 'SPCX'), # high value on second day of trading
+                ('2020-03-12', 'ESGU'), # short high value on during large uncertainty
+                ('2020-03-17', 'DRIV'), # short high value on during large uncertainty
+                ('2020-02-03', 'EAGG')] # short high value on during large uncertainty
+    # dropping them together copies the frame once, where each del splits its block
+    # spreads need far less than double precision; one sorted float32 block halves memory traffic
+    quoted_spread = quoted_spread.drop(columns=outliers).astype(np.float32).sort_index(axis=1)
+
+    all_dates = list(quoted_spread.columns.levels[0])
+    all_dates.sort()
+    all_etfs = list(quoted_spread.columns.levels[1])
+    return quoted_spread, all_dates, all_etfs
+
+@st.cache(allow_output_mutation=True, show_spinner=False)
+def load_etf_metadata(path='etf.csv'):
+    """
+    Load bulk data about the ETFs used for data collection. Cached across reruns.
+
+    Parameters
+    ----------
+    path : str, optional
+        CSV file of ETF data. The default is 'etf.csv'.
+
+    Returns
+    -------
+    etf_data : pd.DataFrame
+        Dataframe containing bulk data about ETFs.
+    log_bounds : dict
+        Floor and ceiling of log10 of the min and max of the slider columns.
+
+    """
+    etf_data = pd.read_csv(path, index_col='Symbol')
+    etf_data = etf_data[etf_data['for_data'] == True]
+    # slider bounds only depend on the data, so compute them once here
+    log_bounds = {}
+    for column in ['volume (shares/day)', 'net assets (million USD)']:
+        log_bounds[column] = (float(np.floor(np.log10(etf_data[column].min()))),
+                              float(np.ceil(np.log10(etf_data[column].max()))))
+    return etf_data, log_bounds
+
+# one markdown element for the whole header instead of one per line
+st.markdown("""# Bid-Ask spreads. Does time of day matter?
+#### By Mark Goldman
+first published March 10, 2021""")
 
 intro = st.beta_expander("Introduction")
 data_selection = st.beta_expander("Data selection")
@@ -464,25 +656,14 @@ conclusion = st.beta_expander("Conclusion")
 methods = st.beta_expander("Methods")
 disclaimer = st.beta_expander("Disclaimer")
 
-quoted_spread = pd.read_pickle('data/quoted_spread.pkl')
-
-# remove outliers that impact average
-del quoted_spread[('2020-12-16', 'SPCX')] # high value on second day of trading
-del quoted_spread[('2020-03-12', 'ESGU')] # short high value on during large uncertainty
-del quoted_spread[('2020-03-17', 'DRIV')] # short high value on during large uncertainty
-del quoted_spread[('2020-02-03', 'EAGG')] # short high value on during large uncertainty
-
-all_dates = list(quoted_spread.columns.levels[0])
-all_dates.sort()
-all_etfs = list(quoted_spread.columns.levels[1])
-etf_data = pd.read_csv('etf.csv', index_col='Symbol')
-etf_data = etf_data[etf_data['for_data'] == True]
+quoted_spread, all_dates, all_etfs = load_quoted_spread()
+etf_data, log_bounds = load_etf_metadata()
 start, end = data_selection.select_slider('Dates to analyze', all_dates, (all_dates[0], all_dates[-1]))
 selected_dates = all_dates[all_dates.index(start):all_dates.index(end)]
 method_choose_etfs = data_selection.multiselect('Methods for selecting ETFs',
                                     ['By volume traded', 'By market cap', 'Only ESG ETFs', 'choose specific ETFs'], ['choose specific ETFs'])
 
-selected_etfs = display_method_to_choose_etfs(method_choose_etfs, all_etfs,etf_data,sl_obj=data_selection)
+selected_etfs = display_method_to_choose_etfs(method_choose_etfs, all_etfs,etf_data,log_bounds,sl_obj=data_selection)
 
 left_column, right_column = data_selection.beta_columns(2)
 t_old = right_column.slider('Old trading window timing',
@@ -509,9 +690,9 @@ elif len(selected_etfs) == 1:
 else:
     results.bokeh_chart(make_multi_etf_plot(selected_etfs,selected_dates, t_new, t_old, quoted_spread))
 
-results.write(r"Quoted spreads $\left(\frac{ask - bid}{(ask + bid)/2}\right)$ were obtained from full volume stock market data")
+results.markdown(r"""Quoted spreads $\left(\frac{ask - bid}{(ask + bid)/2}\right)$ were obtained from full volume stock market data
 
-results.write("#### Relative increase in Bid-Ask spread when moving to new time window:")
+#### Relative increase in Bid-Ask spread when moving to new time window:""")
 
 relative_spreads = get_quoted_spread_change(selected_etfs, selected_dates, t_old, t_new, quoted_spread)
 create_metrics(relative_spreads, container = results)
@@ -520,10 +701,8 @@ results.write("""This spread is not the only fee that ETF investors might face.
               is an annual fee that ETF funds charge, known as the [expense ratio](https://en.wikipedia.org/wiki/Expense_ratio). Let's compare
               it with quoted spreads in the new trade window by taking the ratio of the two.""")   
 
-df = get_averages(quoted_spread, selected_dates, selected_etfs)
-new_quotes = df[(df.index > t_new[0]) & (df.index < t_new[1])].mean(0)
 t_new_text = '{}:{}-{}:{}'.format(t_new[0].hour, t_new[0].minute,t_new[1].hour, t_new[1].minute)
-ratio = (new_quotes / (etf_data.loc[selected_etfs,'expense ratio']/100)).sort_values(ascending=False)
+ratio = get_expense_ratio_comparison(selected_etfs, selected_dates, t_new, quoted_spread, etf_data)
 results.bokeh_chart(make_relative_fee_amount(ratio,t_new_text))
 
 results.write("""To put this ratio in perspective, a ratio of 100% in the plot above indicates that if:
@@ -536,9 +715,7 @@ then the cost due to the bid-ask spread is approximately equal to the expense
 ratio that you paid to the fund.
 """)
 
-def write_intro():
-    
-    intro.write("""     
+INTRO_TEXT = """     
     One investment cost that investors may overlook is the [bid-ask spread](https://en.wikipedia.org/wiki/Bid%E2%80%93ask_spread),
     which is the difference between the selling and buying price for a stock. When executing trades, your broker will send
     your order to a [market maker](https://en.wikipedia.org/wiki/Market_maker), which makes money by giving the seller less money 
@@ -566,11 +743,9 @@ def write_intro():
 
     I wanted to understand how much the bid-ask spread changes over the course of the day and if that even was significant to investors using M1. Below is one example showing quoted bid and ask prices, where you can see the higher gap during
     the start of trading.
-    """)
-    
-    intro.bokeh_chart(make_bid_ask_plot('ESGV','2021-02-03',t_new, t_old, 'data/'))
-    
-    intro.write("""
+    """
+
+INTRO_CONTINUED_TEXT = """
 
     Unfortunately unlike commissions or expense ratios, the bid-ask 
     spread costs are less transparent. The quoted prices on the exchange are not the same as the prices the market makers give.
@@ -584,10 +759,17 @@ def write_intro():
     Then check out the 'Data selection' tab to view different ETFs, dates, and trading window timings. If you want to dig 
     deeper than this analysis, read the methods section, download the [repository](https://github.com/goldmanm/bid-ask-visualization), and start playing with your own data.
 
-    """)
+    """
 
-def write_methods():
-    methods.write(r"""
+def write_intro():
+    
+    intro.markdown(INTRO_TEXT)
+    
+    intro.bokeh_chart(make_bid_ask_plot('ESGV','2021-02-03',t_new, t_old, 'data/'))
+    
+    intro.markdown(INTRO_CONTINUED_TEXT)
+
+METHODS_TEXT = r"""
     Raw bid and ask prices, while important, are not the most useful quantity to consider. 
     Derived from these values is the [quoted spread](https://en.wikipedia.org/wiki/Bid%E2%80%93ask_spread),
     which gives an indication of the percent
@@ -635,9 +817,12 @@ def write_methods():
     because either they are commonly traded, they screen for Environmental, Social, or Governance 
     (ESG) qualities, or they cover specific sectors. ETFs were not added nor removed based on expected change in price ratio."
     
-    """)
-def write_conclusion():
-    conclusion.write("""
+    """
+
+def write_methods():
+    methods.markdown(METHODS_TEXT)
+
+CONCLUSION_TEXT = """
 For the vast majority of ETFs evaluated here, trading at the market opening window had substantially wider quoted spreads. 
 This is true for both ETF behemoths (e.g. VTI) and newcomers (e.g. VCEB) across a wide range of sectors. 
 Some of the additional spread  at market opening can be taken by the market makers, leading traders to pay a higher cost. Investors should take note of this cost when deciding when to execute trades. 
@@ -664,14 +849,19 @@ Like any project, this analysis leaves many unanswered questions:
 
 Time may help answer some of these questions, though it's unlikely to happen without significant transparency on M1's part.
 I truly hope that the change in timing was in the best interest of investors, but I have yet to see much evidence of that.
-    """)
+    """
 
-def write_disclaimer():
-    disclaimer.write("""I received no compensation for working on this project, nor do I hold a stake in
+def write_conclusion():
+    conclusion.markdown(CONCLUSION_TEXT)
+
+DISCLAIMER_TEXT = """I received no compensation for working on this project, nor do I hold a stake in
                      M1 or its competitors (except for what is in the broad-based ETFs that I invest in). 
 
 This analysis and code is listed under an [MIT licence](https://mit-license.org/), which does not include any warranty of any kind. 
-This information is not intended to inform investment decisions. If you notice any mistakes, feel free to post an issue on [github](https://github.com/goldmanm/bid-ask-visualization).""")
+This information is not intended to inform investment decisions. If you notice any mistakes, feel free to post an issue on [github](https://github.com/goldmanm/bid-ask-visualization)."""
+
+def write_disclaimer():
+    disclaimer.markdown(DISCLAIMER_TEXT)
 
 write_intro()
 write_methods()
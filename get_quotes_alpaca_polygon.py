@@ -1,14 +1,44 @@
 import os
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from multiprocessing.util import Finalize
 from requests.exceptions import HTTPError
 
 import pandas as pd
 import numpy as np
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 
 from polygon import RESTClient
 import alpaca_trade_api as ati
 
+from analyze_data import get_saved_days, save_symbol_quotes
+
 data_columns = ['bid','ask']
 
+@lru_cache(maxsize=None)
+def get_market_hours(date):
+    """
+    Get the opening and closing times of a regular market day.
+
+    Parameters
+    ----------
+    date : str
+        Date string in format to be read by pandas.Timestamp ('YYYY-MM-DD').
+
+    Returns
+    -------
+    int
+        9:30 am in ns after UNIX epoch.
+    int
+        4 pm in ns after UNIX epoch.
+
+    """
+    market_open = pd.Timestamp(date, tz='US/Eastern') + pd.Timedelta(hours=9, minutes=30)
+    market_close = market_open + pd.Timedelta(hours=6, minutes=30)
+    return market_open.value, market_close.value
+
 def get_data_for_symbol(symbol, client, date, stop_time=None, start_time=None, limit=200):
     """
     Fetches full volume quote data from polygon.io for a symbol and a chosen date.
@@ -36,13 +66,13 @@ def get_data_for_symbol(symbol, client, date, stop_time=None, start_time=None, l
         retrieved data with the index being seconds after 9:30am.
 
     """
+    market_open, market_close = get_market_hours(date)
     if start_time is None:
-        dt = pd.Timestamp(date, tz='US/Eastern') + pd.Timedelta(hours=9, minutes=30)
-        start_time = int(dt.tz_convert('UTC').asm8)
+        start_time = market_open
     if stop_time is None:
-        dt = pd.Timestamp(date, tz='US/Eastern') + pd.Timedelta(hours=16, minutes=0)
-        stop_time = int(dt.tz_convert('UTC').asm8)
-    result=[]
+        stop_time = market_close
+    # one array per column and response instead of one dict per quote
+    times, bids, asks = [], [], []
     counter=0
     while (start_time < stop_time) and (counter < limit):
         counter += 1
@@ -57,19 +87,24 @@ def get_data_for_symbol(symbol, client, date, stop_time=None, start_time=None, l
         if not response.results:
             print('Response was empty for {} on {} at {}'.format(symbol, date, start_time))
             return 0, pd.DataFrame()
-        result += [{'time':r['t'], 'bid':r['p'], 'ask':r['P']} for r in response.results]
+        n_results = len(response.results)
+        times.append(np.fromiter((r['t'] for r in response.results), dtype=np.int64, count=n_results))
+        # prices stay in double precision, a cent spread on a high price is close to single precision's rounding
+        bids.append(np.fromiter((r['p'] for r in response.results), dtype=np.float64, count=n_results))
+        asks.append(np.fromiter((r['P'] for r in response.results), dtype=np.float64, count=n_results))
         start_time = response.results[-1]['t']
         if len(response.results) != 50000:
             break
     if (counter == limit) and (start_time < stop_time):
-        print('limit reached at {} samples'.format(len(result)))
+        print('limit reached at {} samples'.format(sum(len(t) for t in times)))
         success = False
     else:
         success = True
-    ba_df = pd.DataFrame(result)
-    ba_df = ba_df.loc[ba_df.time < stop_time, :]
-    ba_df.index = (pd.DatetimeIndex(ba_df.time,tz='UTC') - pd.Timestamp(date, tz='US/Eastern').tz_convert('UTC') - pd.Timedelta(hours=9, minutes=30)) / pd.Timedelta(seconds=1)
-    del ba_df['time']
+    times, bids, asks = np.concatenate(times), np.concatenate(bids), np.concatenate(asks)
+    in_market = times < stop_time
+    # seconds stay in double precision, single precision only resolves milliseconds late in the day
+    seconds = (times[in_market] - market_open) / 1e9
+    ba_df = pd.DataFrame({'bid': bids[in_market], 'ask': asks[in_market]}, index=seconds)
     return success, ba_df
 
 def get_time_averages(series, averaging_seconds=5, start_time = 0, end_time = 3600 * 6.5):
@@ -78,54 +113,69 @@ def get_time_averages(series, averaging_seconds=5, start_time = 0, end_time = 36
 
     Parameters
     ----------
-    series : pd.Series
-        A column of data from the DataFrame obtained from get_data_from_symbol.
+    series : pd.Series or pd.DataFrame
+        A column of data from the DataFrame obtained from get_data_from_symbol,
+        or several columns sharing the index, which are averaged together.
     averaging_seconds : int, optional
         Number of seconds to average bid ask spreads to. The default is 5.
     start_time : int, optional
         What time (seconds) after start time to start averaging data. The default is 0.
     end_time : int, optional
         What time (seconds) after start time to start averaging data. The default is 3600 * 6.5.
+        Data after this time is ignored.
 
     Returns
     -------
-    pd.Series
+    pd.Series or pd.DataFrame
         data of time averages with index being the midpoint between the times
 
+    Raises
+    ------
+    ValueError
+        If there is no data at or before end_time to average.
+
     """
     time_cutoffs = np.arange(start_time, end_time + averaging_seconds, averaging_seconds)
-    average_data = np.zeros(len(time_cutoffs) - 1)
-    
-    #initialize loop parameters
-    cutoff_index = 0
-    lower_bound = time_cutoffs[cutoff_index]
-    higher_bound = time_cutoffs[cutoff_index + 1]
-    previous_time = start_time
-    previous_value = series.iloc[0]
-    for time, value in zip(series.index, series.values):
-        while time > higher_bound:
-            # finish this section and extend to next section
-            deltat = higher_bound - previous_time
-            average_data[cutoff_index] += deltat * previous_value / averaging_seconds
-            cutoff_index += 1
-            lower_bound = higher_bound
-            higher_bound = time_cutoffs[cutoff_index + 1]
-            previous_time = lower_bound
-        # save value to averaged_data
-        deltat = time - previous_time
-        average_data[cutoff_index] += deltat * previous_value / averaging_seconds
-        previous_time = time
-        previous_value = value
-    # reached end so fill with last partial datapoint
-    deltat = higher_bound - previous_time
-    average_data[cutoff_index] += deltat * previous_value / averaging_seconds
+    times = series.index.to_numpy(dtype=np.float64)
+    # samples after end_time do not change the averages, so a narrow time range only processes its own samples
+    n_samples = np.searchsorted(times, time_cutoffs[-1], side='right')
+    if n_samples == 0:
+        raise ValueError('No data at or before {} seconds to average'.format(time_cutoffs[-1]))
+    # accumulate in double precision. one column per averaged series
+    values = series.to_numpy(dtype=np.float64).reshape(len(series), -1)
+    times, values = times[:n_samples], values[:n_samples]
+    # averaging ends at the upper cutoff of the last sample's section
+    last_section = max(np.searchsorted(time_cutoffs, times[-1], side='left') - 1, 0)
+
+    # split the steps between samples at every cutoff they cross. samples sort before
+    # cutoffs at the same time, so contributions are summed in the same order as a loop would.
+    # the steps only depend on the times, so they are found once for all columns
+    cutoffs = time_cutoffs[1:last_section + 2]
+    points = np.concatenate(([start_time], times, cutoffs))
+    # row of values held from each point on, cutoffs get a row of zeros
+    point_rows = np.concatenate(([0], np.arange(len(times)), np.full(len(cutoffs), len(times))))
+    is_sample = np.concatenate((np.ones(len(times) + 1, dtype=bool), np.zeros(len(cutoffs), dtype=bool)))
+    order = np.argsort(points, kind='stable')
+    points, point_rows, is_sample = points[order], point_rows[order], is_sample[order]
+    # each step holds the value of the latest sample at or before its start
+    latest_sample = np.maximum.accumulate(np.where(is_sample, np.arange(len(points)), 0))
+    step_rows = point_rows[latest_sample[:-1]]
+
+    # each step belongs to the section that its end time falls in
+    step_sections = np.maximum(np.searchsorted(time_cutoffs, points[1:], side='left') - 1, 0)
+    step_durations = np.diff(points)
+    values = np.concatenate((values, np.zeros((1, values.shape[1]))))
+    average_data = np.empty((len(time_cutoffs) - 1, values.shape[1]))
+    for column in range(values.shape[1]):
+        step_averages = step_durations * values[step_rows, column] / averaging_seconds
+        average_data[:, column] = np.bincount(step_sections, weights=step_averages, minlength=len(average_data))
     # fill in the rest of the data with the last point
-    cutoff_index += 1
-    while cutoff_index < len(average_data):
-        average_data[cutoff_index] = previous_value
-        cutoff_index += 1
-    # create_pandas series to return 
-    return pd.Series(index=time_cutoffs[:-1]+(averaging_seconds/2), data=average_data)
+    average_data[last_section + 1:] = values[-2]
+    # create pandas data to return
+    midpoints = time_cutoffs[:-1]+(averaging_seconds/2)
+    if isinstance(series, pd.DataFrame):
+        return pd.DataFrame(average_data, index=midpoints, columns=series.columns)
+    return pd.Series(index=midpoints, data=average_data[:, 0])
 
 def get_volume_traded(etfs, dates, client):
     """
@@ -137,25 +187,24 @@ def get_volume_traded(etfs, dates, client):
         List of strings of ETFs to collect volume data from.
     dates : list of str
         List of strings in YYYY-MM-DD format.
-    client : TYPE
-        Alpaca api client for fetching market data.
+    client : RESTClient
+        polygon.io api client for fetching market data.
 
     Returns
     -------
     pd.Series
         Average volume data for various ETFs
     """
-    avg_volume = []
-    for etf in etfs:
-        volumes = 0
-        for date in dates:
-            try:
-                response = client.stocks_equities_daily_open_close(etf, dates)
-            except HTTPError:
-                continue
-            volumes += response.volume
-        avg_volume.append(volumes/len(dates))
-    return pd.Series(index=etfs, data=avg_volume)
+    volumes = pd.Series(0, index=etfs, dtype=np.float64)
+    for date in dates:
+        # one request returns the daily bars of every stock on the date
+        try:
+            response = client.stocks_equities_grouped_daily('us', 'stocks', date)
+        except HTTPError:
+            continue
+        day_volumes = pd.Series({bar['T']: bar['v'] for bar in response.results}, dtype=np.float64)
+        volumes += day_volumes.reindex(volumes.index, fill_value=0)
+    return volumes / len(dates)
 
 def get_valid_market_days(start_day, end_day):
     """
@@ -182,31 +231,119 @@ def get_valid_market_days(start_day, end_day):
            valid_days.append(str(calendar.date)[:10])
     return valid_days
 
+def get_averaged_quotes(symbol, date, client):
+    """
+    Fetches quotes for one symbol and day and averages them.
+
+    Parameters
+    ----------
+    symbol : str
+        STOCK/ETF name to get data of
+    date : str
+        Date string in format YYYY-MM-DD.
+    client : RESTClient
+        polygon.io api client for fetching data
+
+    Returns
+    -------
+    pd.DataFrame
+        time, bid, ask and relative spread columns of averaged data. None if
+        the data could not be collected.
+
+    """
+    success, df = get_data_for_symbol(symbol, client, date)
+    if not success:
+        print('error {}_{}'.format(date, symbol))
+        return None
+    # 2*(ask - bid)/(ask + bid), computed in place to avoid full length temporaries
+    bid, ask = df['bid'].to_numpy(), df['ask'].to_numpy()
+    relative_spread = ask - bid
+    relative_spread *= 2
+    relative_spread /= ask + bid
+    df['relative spread'] = relative_spread
+    # the three columns share their times, so they are averaged in one pass
+    average_data = get_time_averages(df)
+    print('finished {}_{}'.format(date, symbol))
+    # only the averages are stored in single precision
+    return average_data.rename_axis('time').reset_index().astype(np.float32)
+
+# polygon.io client of a download process, see start_worker_client
+worker_client = None
+
+def start_worker_client(key):
+    """
+    Creates the polygon.io client used by get_averaged_quotes_in_worker in this process.
+
+    The client is closed when the process exits.
+
+    Parameters
+    ----------
+    key : str
+        polygon.io api key.
+
+    Returns
+    -------
+    None.
+
+    """
+    global worker_client
+    worker_client = RESTClient(key)
+    # pool processes exit without running atexit hooks, but run multiprocessing finalizers
+    Finalize(worker_client, worker_client.close, exitpriority=10)
+
+def get_averaged_quotes_in_worker(symbol, date):
+    """
+    Runs get_averaged_quotes with the client of a process started with start_worker_client.
+
+    Parameters
+    ----------
+    symbol : str
+        STOCK/ETF name to get data of
+    date : str
+        Date string in format YYYY-MM-DD.
+
+    Returns
+    -------
+    pd.DataFrame
+        See get_averaged_quotes.
+
+    """
+    return get_averaged_quotes(symbol, date, worker_client)
+
 if __name__ == '__main__':
     key = os.getenv('APCA_API_KEY_ID')
     dates = []
     dates += get_valid_market_days('2019-12-29', '2020-07-01')
     with RESTClient(key) as client:
-        etf_df = pd.read_csv('etf.csv', index_col = 'Symbol')
-        etfs = etf_df[etf_df['for_data'] == True].index
+        # only the symbols and their flags are needed from the ETF list
+        etf_table = pa_csv.read_csv('etf.csv', convert_options=pa_csv.ConvertOptions(include_columns=['Symbol', 'for_data']))
+        etfs = etf_table.filter(pc.equal(etf_table['for_data'], True)).column('Symbol').to_pylist()
 
-        for date in dates:
+        saved = get_saved_days()
+        # decoding the quotes holds the gil, so download in processes. a few in flight stay under polygon's rate limits
+        with ProcessPoolExecutor(max_workers=4, initializer=start_worker_client, initargs=(key,)) as executor:
+            futures = {}
             for symbol in etfs:
-                try:
-                    with open('data/{}_{}.csv'.format(date, symbol)) as f:
-                        print('data/{}_{}.csv already exists'.format(date, symbol))
-                except FileNotFoundError:
-                    success, df = get_data_for_symbol(symbol, client, date)
-                    if success:
-                        spread_fraction = 2*(df.ask - df.bid)/(df.ask + df.bid)
-                
-                        average_data = pd.DataFrame()
-                        average_data['bid'] = get_time_averages(df['bid'])
-                        average_data['ask'] = get_time_averages(df['ask'])
-                        average_data['relative spread'] = get_time_averages(spread_fraction)
-                        average_data.to_csv('data/{}_{}.csv'.format(date, symbol))
-                        print('finished {}_{}'.format(date, symbol))
+                for date in dates:
+                    # days downloaded before the dataset was used are kept as csv files
+                    if (symbol, date) in saved or os.path.exists('data/{}_{}.csv'.format(date, symbol)):
+                        print('data for {} on {} already exists'.format(symbol, date))
                     else:
-                        print('error {}_{}'.format(date, symbol))
-        volume = get_volume_traded(etfs, dates[-1], client)
+                        futures[executor.submit(get_averaged_quotes_in_worker, symbol, date)] = (symbol, date)
+            # each symbol is saved once all its days are done, a failed day is skipped
+            remaining = Counter(symbol for symbol, date in futures.values())
+            frames = defaultdict(dict)
+            for future in as_completed(futures):
+                symbol, date = futures[future]
+                try:
+                    frame = future.result()
+                except Exception as e:
+                    print('error {}_{}: {!r}'.format(date, symbol, e))
+                    frame = None
+                if frame is not None:
+                    frames[symbol][date] = frame
+                remaining[symbol] -= 1
+                if remaining[symbol] == 0 and frames[symbol]:
+                    save_symbol_quotes(symbol, frames.pop(symbol))
+        volume = get_volume_traded(etfs, dates[-1:], client)
         volume.to_csv('data/etf_info.csv')
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the functions in analyze_data.py that find and average the saved
+bid-ask data.
+
+@author: mark
+"""
+
+import contextlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from analyze_data import (MARKET_OPEN, MARKET_SECONDS, bucket_mean, bucket_midpoints, get_date_etf_list_from_data,
+                          get_saved_days, migrate_to_parquet, read_quoted_spread, save_symbol_quotes)
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+def resample_mean(seconds, values, sample_frequency):
+    """
+    Bucket means found with pandas' resample, to compare bucket_mean against.
+    """
+    n_buckets = int(np.ceil(MARKET_SECONDS / sample_frequency))
+    nanoseconds = np.round(seconds * 1e9).astype(np.int64).astype('timedelta64[ns]')
+    frame = pd.DataFrame(values.reshape(len(seconds), -1), index=pd.DatetimeIndex(MARKET_OPEN + nanoseconds))
+    means = frame.resample('{}S'.format(sample_frequency), origin=pd.Timestamp(MARKET_OPEN)).mean()
+    bucket_starts = np.arange(n_buckets) * sample_frequency * 10**9
+    return means.reindex(pd.DatetimeIndex(MARKET_OPEN + bucket_starts.astype('timedelta64[ns]'))).to_numpy()
+
+def test_bucket_mean_regular_grid():
+    # 5 second averages as saved by get_quotes_alpaca_polygon.py, which take the reshape path
+    rng = np.random.default_rng(0)
+    seconds = 2.5 + 5 * np.arange(4680)
+    values = rng.uniform(0, 0.01, (4680, 3)).astype(np.float32)
+    values[rng.random(values.shape) < 0.1] = np.nan
+    values[:12, 1] = np.nan
+    means = bucket_mean(seconds, values, 60)
+    assert means.shape == (390, 3)
+    assert np.isnan(means[0, 1])
+    np.testing.assert_allclose(means, resample_mean(seconds, values, 60), rtol=1e-6)
+    np.testing.assert_allclose(bucket_mean(seconds, values[:, 0], 60), means[:, 0], rtol=1e-6)
+
+def test_bucket_mean_irregular_times():
+    # uneven samples, some outside the trading day, take the reduceat path
+    rng = np.random.default_rng(1)
+    seconds = np.sort(rng.uniform(-100, MARKET_SECONDS + 100, 20000))
+    seconds[100:110] = seconds[100]
+    values = rng.uniform(0, 0.01, (len(seconds), 2)).astype(np.float32)
+    values[rng.random(values.shape) < 0.1] = np.nan
+    for sample_frequency in [60, 7, 300]:
+        means = bucket_mean(seconds, values, sample_frequency)
+        np.testing.assert_allclose(means, resample_mean(seconds, values, sample_frequency), rtol=1e-6)
+
+def test_bucket_mean_sparse_data():
+    seconds = np.array([10.0, 20.0, 3000.0])
+    values = np.array([1.0, np.nan, 3.0])
+    means = bucket_mean(seconds, values, 60)
+    assert means[0] == 1
+    assert means[50] == 3
+    assert np.isnan(means[1:50]).all() and np.isnan(means[51:]).all()
+    np.testing.assert_array_equal(means, resample_mean(seconds, values, 60).ravel())
+    assert np.isnan(bucket_mean(np.array([-5.0]), np.array([1.0]), 60)).all()
+
+def test_bucket_midpoints():
+    for sample_frequency in [60, 7, 300]:
+        midpoints = bucket_midpoints(sample_frequency)
+        assert len(midpoints) == len(bucket_mean(np.array([0.0]), np.array([1.0]), sample_frequency))
+        assert midpoints[0] == sample_frequency / 2
+        np.testing.assert_allclose(np.diff(midpoints), sample_frequency)
+        assert midpoints[-1] - sample_frequency / 2 < MARKET_SECONDS <= midpoints[-1] + sample_frequency / 2
+
+def test_date_etf_list_follows_added_and_removed_files(tmp_path):
+    for name in ['2021-02-01_ESGV.csv', '2021-02-02_VTI.csv', '2021-02-02_BND.parquet', 'notes.txt']:
+        (tmp_path / name).touch()
+    assert get_date_etf_list_from_data(tmp_path) == (['2021-02-01', '2021-02-02'], ['ESGV', 'VTI'])
+    assert (tmp_path / '_index.json').exists()
+    (tmp_path / '2021-02-03_BND.csv').touch()
+    assert get_date_etf_list_from_data(tmp_path) == (['2021-02-01', '2021-02-02', '2021-02-03'], ['BND', 'ESGV', 'VTI'])
+    (tmp_path / '2021-02-02_VTI.csv').unlink()
+    assert get_date_etf_list_from_data(tmp_path) == (['2021-02-01', '2021-02-03'], ['BND', 'ESGV'])
+
+def test_date_etf_list_file_added_during_scan(tmp_path, monkeypatch):
+    (tmp_path / '2021-02-01_ESGV.csv').touch()
+    get_date_etf_list_from_data(tmp_path)
+    (tmp_path / '2021-02-02_ESGV.csv').touch()
+    scandir = os.scandir
+
+    def scandir_then_add_file(path):
+        # the download script saves a file right after the directory is listed
+        entries = list(scandir(path))
+        (tmp_path / '2021-02-03_ESGV.csv').touch()
+        return contextlib.nullcontext(entries)
+
+    monkeypatch.setattr(os, 'scandir', scandir_then_add_file)
+    assert get_date_etf_list_from_data(tmp_path) == (['2021-02-01', '2021-02-02'], ['ESGV'])
+    monkeypatch.undo()
+    assert get_date_etf_list_from_data(tmp_path) == (['2021-02-01', '2021-02-02', '2021-02-03'], ['ESGV'])
+
+def test_date_etf_list_without_cache(tmp_path):
+    (tmp_path / '2021-02-01_ESGV.csv').touch()
+    assert get_date_etf_list_from_data(tmp_path, use_cache=False) == (['2021-02-01'], ['ESGV'])
+    assert not (tmp_path / '_index.json').exists()
+    # an index matching the directory is trusted unless the cache is bypassed. the first
+    # call creates the index and so changes the directory, the second one matches it
+    get_date_etf_list_from_data(tmp_path)
+    get_date_etf_list_from_data(tmp_path)
+    with open(tmp_path / '_index.json') as f:
+        index = json.load(f)
+    index['etfs'] = ['VTI']
+    with open(tmp_path / '_index.json', 'w') as f:
+        json.dump(index, f)
+    assert index['mtime'] == os.stat(tmp_path).st_mtime_ns
+    assert get_date_etf_list_from_data(tmp_path) == (['2021-02-01'], ['VTI'])
+    assert get_date_etf_list_from_data(tmp_path, use_cache=False) == (['2021-02-01'], ['ESGV'])
+
+def test_quoted_spread_from_dataset_and_single_files(tmp_path):
+    # a day saved as a csv before the dataset, and days of the dataset, one of which also has a csv
+    shutil.copy(os.path.join(DATA_DIRECTORY, '2021-02-03_ESGV.csv'), tmp_path / '2021-02-03_ESGV.csv')
+    shutil.copy(os.path.join(DATA_DIRECTORY, '2021-02-03_ESGV.csv'), tmp_path / '2021-02-04_VTI.csv')
+    averaged = pd.read_csv(os.path.join(DATA_DIRECTORY, '2021-02-03_ESGV.csv'), index_col=0)
+    averaged = averaged.rename_axis('time').reset_index().astype(np.float32)
+    vti = averaged.assign(**{'relative spread': averaged['relative spread'] * 2})
+    save_symbol_quotes('VTI', {'2021-02-04': vti, '2021-02-05': averaged}, tmp_path)
+
+    quoted_spread = read_quoted_spread(tmp_path, ignore_errors=2)
+    assert sorted(quoted_spread.columns) == [('2021-02-03', 'ESGV'), ('2021-02-04', 'VTI'), ('2021-02-05', 'VTI')]
+    (tmp_path / 'single').mkdir()
+    shutil.copy(os.path.join(DATA_DIRECTORY, '2021-02-03_ESGV.csv'), tmp_path / 'single' / '2021-02-03_ESGV.csv')
+    single_file = read_quoted_spread(tmp_path / 'single')
+    np.testing.assert_allclose(quoted_spread[('2021-02-03', 'ESGV')], single_file[('2021-02-03', 'ESGV')], rtol=1e-6)
+    np.testing.assert_allclose(quoted_spread[('2021-02-05', 'VTI')], single_file[('2021-02-03', 'ESGV')], rtol=1e-6)
+    # the dataset is preferred over a file of the same day
+    np.testing.assert_allclose(quoted_spread[('2021-02-04', 'VTI')], 2 * single_file[('2021-02-03', 'ESGV')], rtol=1e-6)
+
+def test_quoted_spread_columns_are_sorted(tmp_path):
+    # days are saved out of order and the csv of a day in the dataset is never read
+    averaged = pd.read_csv(os.path.join(DATA_DIRECTORY, '2021-02-03_ESGV.csv'), index_col=0)
+    averaged = averaged.rename_axis('time').reset_index().astype(np.float32)
+    save_symbol_quotes('VTI', {'2021-02-04': averaged}, tmp_path)
+    save_symbol_quotes('SPY', {'2021-02-05': averaged, '2021-02-04': averaged}, tmp_path)
+    (tmp_path / '2021-02-04_SPY.csv').write_text('not a csv')
+    shutil.copy(os.path.join(DATA_DIRECTORY, '2021-02-03_ESGV.csv'), tmp_path / '2021-02-03_VTI.csv')
+    expected = [('2021-02-03', 'VTI'), ('2021-02-04', 'SPY'), ('2021-02-04', 'VTI'), ('2021-02-05', 'SPY')]
+    for sample_frequency in [60, None]:
+        quoted_spread = read_quoted_spread(tmp_path, sample_frequency, ignore_errors=2)
+        assert list(quoted_spread.columns) == expected
+        assert quoted_spread.columns.is_monotonic_increasing
+    assert quoted_spread.notna().all().all()
+
+def test_migrate_to_parquet(tmp_path):
+    for name in ['2021-02-03_ESGV.csv', '2021-02-04_ESGV.csv', '2021-02-04_VTI.csv']:
+        shutil.copy(os.path.join(DATA_DIRECTORY, '2021-02-03_ESGV.csv'), tmp_path / name)
+    averaged = pd.read_csv(os.path.join(DATA_DIRECTORY, '2021-02-03_ESGV.csv'), index_col=0)
+    averaged = averaged.rename_axis('time').reset_index().astype(np.float32)
+    save_symbol_quotes('VTI', {'2021-02-04': averaged.assign(**{'relative spread': 2 * averaged['relative spread']})},
+                       tmp_path)
+    single_files = read_quoted_spread(tmp_path, ignore_errors=2)
+
+    migrate_to_parquet(tmp_path, ignore_errors=2)
+    assert get_saved_days(tmp_path) == {('ESGV', '2021-02-03'), ('ESGV', '2021-02-04'), ('VTI', '2021-02-04')}
+    # days already in the dataset are not added again
+    migrate_to_parquet(tmp_path, ignore_errors=2)
+    assert len(os.listdir(tmp_path / 'averaged_quotes' / 'symbol=ESGV')) == 1
+    assert len(os.listdir(tmp_path / 'averaged_quotes' / 'symbol=VTI')) == 1
+    for name in ['2021-02-03_ESGV.csv', '2021-02-04_ESGV.csv', '2021-02-04_VTI.csv']:
+        (tmp_path / name).write_text('not a csv')
+    pd.testing.assert_frame_equal(read_quoted_spread(tmp_path, ignore_errors=2), single_files, rtol=1e-6)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the calculations in app.py.
+
+Importing app runs the streamlit script once without a browser, so the
+tests are skipped when streamlit is not installed.
+
+@author: mark
+"""
+
+import os
+from itertools import product
+
+import numpy as np
+import pandas as pd
+import pytest
+
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+@pytest.fixture(scope='module')
+def app():
+    pytest.importorskip('streamlit')
+    # the script reads its data relative to the repository
+    working_directory = os.getcwd()
+    os.chdir(REPO_DIRECTORY)
+    try:
+        import app
+    finally:
+        os.chdir(working_directory)
+    return app
+
+def groupby_averages(data, selected_dates, selected_etfs):
+    """
+    Averages of the selected ETFs found with groupby, to compare get_averages against.
+    """
+    potential_columns = product(selected_dates, selected_etfs)
+    actual_columns = [x for x in potential_columns if x in data.columns]
+    return data[actual_columns].T.groupby(level=['etf']).mean().T
+
+@pytest.fixture(scope='module')
+def quoted_spread():
+    # module scope keeps one frame alive, since get_averages caches results by the frame's id
+    rng = np.random.default_rng(0)
+    dates = ['2021-02-01', '2021-02-02', '2021-02-03', '2021-02-04']
+    etfs = ['BND', 'ESGV', 'SPY', 'VTI']
+    # not every ETF has every day
+    columns = pd.MultiIndex.from_tuples([x for x in product(dates, etfs) if x not in [('2021-02-02', 'VTI'),
+                                         ('2021-02-04', 'VTI'), ('2021-02-03', 'BND')]], names=['dates', 'etf'])
+    index = pd.date_range('2021-01-01 09:30', periods=390, freq='min')
+    values = rng.uniform(0, 0.01, (len(index), len(columns))).astype(np.float32)
+    values[rng.random(values.shape) < 0.2] = np.nan
+    data = pd.DataFrame(values, index=index, columns=columns)
+    # a day without any data and a time without any data for one ETF
+    data[('2021-02-01', 'ESGV')] = np.nan
+    data.loc[index[5], [('2021-02-01', 'SPY'), ('2021-02-02', 'SPY'), ('2021-02-03', 'SPY')]] = np.nan
+    return data
+
+@pytest.mark.parametrize('selected_dates, selected_etfs', [
+    (['2021-02-01', '2021-02-02', '2021-02-03', '2021-02-04'], ['BND', 'ESGV', 'SPY', 'VTI']),
+    (['2021-02-03', '2021-02-01'], ['VTI', 'BND', 'ESGV']),
+    (['2021-02-01', '2021-02-02', '2021-02-03'], ['SPY', 'ESGV']),
+    (['2021-02-02', '2021-02-04', '2021-02-05'], ['VTI', 'SPY', 'QQQ']),
+    (['2021-02-01'], ['ESGV']),
+])
+def test_get_averages_matches_groupby(app, quoted_spread, selected_dates, selected_etfs):
+    averages = app.get_averages(quoted_spread, selected_dates, selected_etfs)
+    expected = groupby_averages(quoted_spread, selected_dates, selected_etfs)
+    pd.testing.assert_frame_equal(averages, expected, check_dtype=False, check_names=False, rtol=1e-6)
+
+def test_get_averages_without_matching_columns(app, quoted_spread):
+    averages = app.get_averages(quoted_spread, ['2021-02-02'], ['QQQ'])
+    assert averages.shape == (len(quoted_spread), 0)
+    assert averages.index.equals(quoted_spread.index)
+
+def test_get_window_quotes_excludes_edges(app, quoted_spread):
+    selected_dates, selected_etfs = ['2021-02-01', '2021-02-02'], ['SPY', 'VTI']
+    df = groupby_averages(quoted_spread, selected_dates, selected_etfs)
+    # one window on sample times and one between them
+    for t_window in [(pd.Timestamp('2021-01-01 10:00'), pd.Timestamp('2021-01-01 10:30')),
+                     (pd.Timestamp('2021-01-01 14:00:30'), pd.Timestamp('2021-01-01 15:59:30'))]:
+        expected = df[(df.index > t_window[0]) & (df.index < t_window[1])].mean(0)
+        window_quotes = app.get_window_quotes(quoted_spread, selected_dates, selected_etfs, t_window)
+        pd.testing.assert_series_equal(window_quotes, expected, check_dtype=False, check_names=False, rtol=1e-6)
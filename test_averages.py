@@ -19,26 +19,128 @@ import numpy as np
 import alpaca_trade_api as ati
 from datetime import datetime
 
-import unittest
-from get_quotes_alpaca_polygon import get_time_averages
-
-s = pd.Series({0:5, 1:6, 2:7})
-averages = get_time_averages(s, 1, 0 , 4)
-correct_averages = [5, 6, 7, 7]
-assert 4 == len(averages)
-for a, b in zip(averages.values, correct_averages):
-    assert a == b
-
-s = pd.Series({0:5, 0.5:6, 2.5:7, 3.5:8})
-averages = get_time_averages(s, 1, 0 , 4)
-correct_averages = [5.5, 6, 6.5, 7.5]
-assert 4 == len(averages)
-for a, b in zip(averages.values, correct_averages):
-    assert a == b
-    
-s = pd.Series({0:5, 0.1:6, 1.75:7, 2:8})
-averages = get_time_averages(s, 1, 0 , 4)
-correct_averages = [5.9, 6.25, 8, 8]
-assert 4 == len(averages)
-for a, b in zip(averages.values, correct_averages):
-    assert a == b
+import pytest
+from get_quotes_alpaca_polygon import get_averaged_quotes, get_market_hours, get_time_averages
+
+def reference_time_averages(series, averaging_seconds=5, start_time = 0, end_time = 3600 * 6.5):
+    """
+    The original loop of get_time_averages over every sample, to compare against.
+    """
+    time_cutoffs = np.arange(start_time, end_time + averaging_seconds, averaging_seconds)
+    average_data = np.zeros(len(time_cutoffs) - 1)
+    cutoff_index = 0
+    higher_bound = time_cutoffs[cutoff_index + 1]
+    previous_time = start_time
+    previous_value = series.iloc[0]
+    for time, value in zip(series.index, series.values):
+        while time > higher_bound:
+            # finish this section and extend to next section
+            average_data[cutoff_index] += (higher_bound - previous_time) * previous_value / averaging_seconds
+            cutoff_index += 1
+            previous_time = higher_bound
+            higher_bound = time_cutoffs[cutoff_index + 1]
+        average_data[cutoff_index] += (time - previous_time) * previous_value / averaging_seconds
+        previous_time = time
+        previous_value = value
+    # reached end so fill with last partial datapoint and the rest with the last point
+    average_data[cutoff_index] += (higher_bound - previous_time) * previous_value / averaging_seconds
+    average_data[cutoff_index + 1:] = previous_value
+    return pd.Series(index=time_cutoffs[:-1]+(averaging_seconds/2), data=average_data)
+
+def random_series(rng, n, end_time):
+    times = np.sort(rng.uniform(0, end_time, n))
+    if n > 10:
+        # samples on the section cutoffs and at repeated times
+        times[::7] = np.round(times[::7])
+        times = np.sort(times)
+    return pd.Series(rng.uniform(100, 101, n), index=times)
+
+def test_constant_sections():
+    s = pd.Series({0:5, 1:6, 2:7})
+    averages = get_time_averages(s, 1, 0 , 4)
+    correct_averages = [5, 6, 7, 7]
+    assert 4 == len(averages)
+    for a, b in zip(averages.values, correct_averages):
+        assert a == b
+
+def test_samples_within_sections():
+    s = pd.Series({0:5, 0.5:6, 2.5:7, 3.5:8})
+    averages = get_time_averages(s, 1, 0 , 4)
+    correct_averages = [5.5, 6, 6.5, 7.5]
+    assert 4 == len(averages)
+    for a, b in zip(averages.values, correct_averages):
+        assert a == b
+
+def test_samples_across_sections():
+    s = pd.Series({0:5, 0.1:6, 1.75:7, 2:8})
+    averages = get_time_averages(s, 1, 0 , 4)
+    correct_averages = [5.9, 6.25, 8, 8]
+    assert 4 == len(averages)
+    for a, b in zip(averages.values, correct_averages):
+        assert a == b
+
+def test_matches_reference_loop():
+    rng = np.random.default_rng(0)
+    for n, end_time, averaging_seconds in [(1, 3600 * 6.5, 5), (3, 3600 * 6.5, 5), (500, 100, 1),
+                                           (5000, 3600 * 6.5, 5), (100000, 3600 * 6.5, 5), (2000, 40, 5)]:
+        s = random_series(rng, n, end_time)
+        averages = get_time_averages(s, averaging_seconds, 0, end_time)
+        expected = reference_time_averages(s, averaging_seconds, 0, end_time)
+        np.testing.assert_array_equal(averages.index, expected.index)
+        np.testing.assert_array_equal(averages.values, expected.values)
+
+def test_data_frame_matches_columns():
+    rng = np.random.default_rng(1)
+    s = random_series(rng, 5000, 3600 * 6.5)
+    df = pd.DataFrame({'bid': s, 'ask': s + rng.uniform(0.01, 0.05, len(s))})
+    df['relative spread'] = 2*(df.ask - df.bid)/(df.ask + df.bid)
+    averages = get_time_averages(df)
+    assert list(averages.columns) == list(df.columns)
+    for column in df:
+        expected = reference_time_averages(df[column])
+        np.testing.assert_array_equal(averages.index, expected.index)
+        np.testing.assert_array_equal(averages[column].values, expected.values)
+
+def test_samples_after_end_time():
+    rng = np.random.default_rng(2)
+    s = random_series(rng, 5000, 3600 * 6.5)
+    for end_time in [3600, 1000, 3602.5]:
+        averages = get_time_averages(s, 5, 0, end_time)
+        # samples after the last section cutoff are ignored
+        last_cutoff = averages.index[-1] + 2.5
+        np.testing.assert_array_equal(averages.values,
+                                      reference_time_averages(s[s.index <= last_cutoff], 5, 0, end_time).values)
+    s = pd.Series({1:1, 7:2, 15:3})
+    assert list(get_time_averages(s, 5, 0, 10).values) == [1, 1.6]
+
+def test_no_data_to_average():
+    with pytest.raises(ValueError):
+        get_time_averages(pd.Series([], dtype=np.float64), 5, 0, 10)
+    with pytest.raises(ValueError):
+        get_time_averages(pd.Series({12:1, 15:2}), 5, 0, 10)
+
+class QuoteResponse:
+    """
+    Response of polygon.io's historic quotes request.
+    """
+    def __init__(self, results):
+        self.success = True
+        self.results = results
+
+class QuoteClient:
+    """
+    polygon.io client returning the same high priced, one cent wide quotes every 10 seconds.
+    """
+    def historic_n___bbo_quotes_v2(self, symbol, date, limit, timestamp):
+        market_open, market_close = get_market_hours(date)
+        return QuoteResponse([{'t': t, 'p': 4123.45, 'P': 4123.46}
+                              for t in range(market_open, market_close, 10 * 10**9)])
+
+def test_relative_spread_precision():
+    averages = get_averaged_quotes('SPY', '2021-02-03', QuoteClient())
+    assert len(averages) == 4680
+    expected = 2 * (4123.46 - 4123.45) / (4123.46 + 4123.45)
+    np.testing.assert_allclose(averages['relative spread'], expected, rtol=1e-6)
+
+if __name__ == '__main__':
+    sys.exit(pytest.main([__file__]))